@@ -1,9 +1,13 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import joblib
-import matplotlib.pyplot as plt
-import gdown
 import os
+import io
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 st.set_page_config(page_title="Airbnb Cold Start Rating Prediction", layout="wide")
 st.title("🏠 Airbnb Cold Start Rating Prediction")
@@ -18,29 +22,168 @@ Upload a CSV file of Airbnb listings **without reviews**, and let our machine le
 ---  
 """)
 
+# Display order of the predicted ratings and the columns offered for filtering
+RATING_ORDER = ["Great", "Average", "Poor"]
+LABEL_OPTIONS = ['room_type', 'city', 'neighborhood', 'host_is_superhost', 'full_time_host']
+MODEL_PATH = "rf_model.pkl"
+
 # Sidebar upload
 with st.sidebar:
     st.header("📤 Upload Data")
     uploaded_file = st.file_uploader("Upload your Airbnb CSV file", type=["csv"])
     st.markdown("👉 File size < 200MB")
 
+# The pickle's mtime; changes (and reloads everything below) when it is replaced
+def get_model_version():
+    return os.stat(MODEL_PATH).st_mtime_ns if os.path.exists(MODEL_PATH) else None
+
 # Load model from Google Drive
-@st.cache_resource
-def load_model():
+@st.cache_resource(max_entries=1)
+def load_model(model_version):
     url = "https://drive.google.com/uc?id=1HVDUDq74DsL5hMRwcL9bFBK9wgJOvgZ-"  # ← 你的模型ID
-    output = "rf_model.pkl"
+    output = MODEL_PATH
     if not os.path.exists(output):
+        import gdown  # only needed on first run, before the model is cached locally
         st.info("📥 Downloading model...")
         gdown.download(url, output, quiet=False)
         st.success("✅ Model downloaded!")
     try:
-        return joblib.load(output)
+        model = joblib.load(output)
     except Exception as e:
         st.error("❌ Failed to load model.")
         st.exception(e)
         st.stop()
 
-model = load_model()
+    # The pickled forest predicts on one core by default; spread trees across all
+    if hasattr(model, "n_jobs"):
+        model.n_jobs = os.cpu_count() or 1
+
+    # Importances never change for a loaded model, so rank them once here
+    importance_df = None
+    if hasattr(model, "feature_importances_"):
+        importance_df = pd.DataFrame({
+            "Feature": model.feature_names_in_,
+            "Importance": model.feature_importances_
+        }).sort_values("Importance", ascending=False).head(10).reset_index(drop=True)
+    return model, importance_df
+
+model_version = get_model_version()
+model, importance_df = load_model(model_version)
+
+# Convert the forest to ONNX once and serve it with ONNX Runtime when available;
+# returns None (plain sklearn predict) if the runtime or converter is missing
+@st.cache_resource(max_entries=1)
+def load_onnx_session(_model, model_version):
+    try:
+        import onnxruntime as ort
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+    except ImportError:
+        return None
+
+    output = "rf_model.onnx"
+    try:
+        # Re-convert whenever the pickle is newer than the cached ONNX file
+        if not os.path.exists(output) or os.path.getmtime(output) < os.path.getmtime(MODEL_PATH):
+            onx = convert_sklearn(
+                _model,
+                initial_types=[("X", FloatTensorType([None, _model.n_features_in_]))],
+                options={id(_model): {"zipmap": False}},
+            )
+            with open(output + ".tmp", "wb") as f:
+                f.write(onx.SerializeToString())
+            os.replace(output + ".tmp", output)
+        return ort.InferenceSession(output, providers=["CPUExecutionProvider"])
+    except Exception as e:
+        st.warning(f"⚠️ ONNX Runtime unavailable, falling back to scikit-learn: {e}")
+        return None
+
+session = load_onnx_session(model, model_version)
+
+# Stream uploads block by block with Arrow's multi-threaded CSV reader. Only the
+# model's features are parsed, so types inferred from the first block of unused
+# columns can't break later blocks; features are typed up front as well
+def iter_upload_chunks(file_bytes, expected_cols):
+    # Type features from a small pandas sample: True/False columns (bool flags,
+    # get_dummies output) stay bool, everything else is read at full float64
+    # precision for display/download; predict_chunk narrows to float32
+    sample = pd.read_csv(io.BytesIO(file_bytes), nrows=100)
+    missing = [c for c in expected_cols if c not in sample.columns]
+    column_types = {
+        c: pa.bool_() if c in sample.columns and sample[c].dtype == bool else pa.float64()
+        for c in expected_cols
+    }
+    read_options = pacsv.ReadOptions(block_size=16 << 20, use_threads=True)
+    # Listing names/descriptions are often quoted multi-line fields
+    parse_options = pacsv.ParseOptions(newlines_in_values=True)
+    convert_options = pacsv.ConvertOptions(
+        column_types=column_types,
+        true_values=["True", "true", "TRUE"],
+        false_values=["False", "false", "FALSE"],
+        include_columns=list(expected_cols),
+        include_missing_columns=True,
+    )
+    reader = pacsv.open_csv(
+        io.BytesIO(file_bytes), read_options=read_options, parse_options=parse_options,
+        convert_options=convert_options,
+    )
+    for batch in reader:
+        # Features absent from the upload come back as nulls; fill them with 0
+        yield batch.to_pandas().fillna(dict.fromkeys(missing, 0))
+
+def predict_chunk(df, model, session=None):
+    # sklearn trees work in float32 internally; hand them one contiguous block
+    X = np.ascontiguousarray(df.to_numpy(dtype=np.float32))
+    # Return integer class codes (argmax over probabilities, same rule as predict)
+    # instead of an object array of label strings
+    if session is not None:
+        proba = session.run(None, {"X": X})[1]
+    else:
+        proba = model.predict_proba(X)
+    return proba.argmax(axis=1).astype(np.int8)
+
+# Predictions are cached in memory per file, keyed on the content hash rather than
+# re-hashing the raw bytes on every call; model_version (the pickle's mtime)
+# invalidates entries when the model is replaced
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_predict(file_hash: str, model_version: int, _file_bytes: bytes, expected_cols: tuple,
+                   _model, _session=None) -> pd.DataFrame:
+    # Predict each chunk on a worker thread while the next one is parsed;
+    # both sklearn and ONNX Runtime release the GIL during inference
+    chunks, futures = [], []
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        for chunk in iter_upload_chunks(_file_bytes, expected_cols):
+            chunks.append(chunk)
+            futures.append(pool.submit(predict_chunk, chunk, _model, _session))
+    df = pd.concat(chunks, ignore_index=True)
+
+    # Categoricals let value_counts and filtering work on integer codes;
+    # known ratings come first in display order, any other classes follow,
+    # so model class indices are remapped to display positions
+    classes = list(_model.classes_)
+    categories = [c for c in RATING_ORDER if c in classes] + [c for c in classes if c not in RATING_ORDER]
+    to_display = np.array([categories.index(c) for c in classes], dtype=np.int8)
+    codes = to_display[np.concatenate([f.result() for f in futures])]
+    df["Predicted_Rating"] = pd.Categorical.from_codes(codes, categories=categories, ordered=True)
+    for col in LABEL_OPTIONS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+# Raw first rows of the upload, all columns, for the preview
+@st.cache_data(show_spinner=False, max_entries=8)
+def read_preview(file_hash: str, _file_bytes: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(_file_bytes), nrows=5)
+
+# Serialize downloads straight to UTF-8 bytes with Arrow's CSV writer, cached
+# on the content of the (filtered) frame so re-clicks don't re-serialize
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={
+    pd.DataFrame: lambda d: pd.util.hash_pandas_object(d, index=False).values.tobytes()
+})
+def to_csv_bytes(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    return buf.getvalue()
 
 with st.expander("📘 Project Introduction"):
     st.markdown("""
@@ -50,78 +193,97 @@ We use listing features like `room_type`, `host status`, and `amenities` to esti
 
 if uploaded_file:
     try:
-        df = pd.read_csv(uploaded_file)
+        # Parse, align with model input and predict only when the upload or the
+        # model file changes
+        file_bytes = uploaded_file.getvalue()
+        file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+        pred_key = (file_hash, model_version)
+        if st.session_state.get("pred_key") != pred_key:
+            st.session_state.df_pred = cached_predict(
+                *pred_key, file_bytes, tuple(model.feature_names_in_), model, session
+            )
+            st.session_state.pred_key = pred_key
+        df = st.session_state.df_pred
         st.subheader("📊 Data Preview")
-        st.dataframe(df.head(), use_container_width=True)
-
-        # Align with model input
-        expected_cols = list(model.feature_names_in_)
-        for col in expected_cols:
-            if col not in df.columns:
-                df[col] = 0
-        df = df[expected_cols]
-
-        # Predict
-        predictions = model.predict(df)
-        df["Predicted_Rating"] = predictions
+        st.dataframe(read_preview(file_hash, file_bytes), use_container_width=True)
         st.success(f"✅ Predictions completed for {len(df)} listings!")
 
-        # --- Sidebar: Choose a label column and value to filter ---
+        # --- Sidebar: Choose a label column and value to filter (no re-prediction) ---
+        # Filter into a separate frame so the cached, unfiltered one stays intact
+        df_view = df
         with st.sidebar:
             st.header("🔖 Optional Filtering")
-            label_options = ['room_type', 'city', 'neighborhood', 'host_is_superhost', 'full_time_host']
-            available_options = [col for col in label_options if col in df.columns]
+            available_options = [col for col in LABEL_OPTIONS if col in df.columns]
             if available_options:
                 group_col = st.selectbox("Select a column to filter by", available_options)
-                selected_value = st.selectbox(f"Value from '{group_col}'", df[group_col].unique())
-                df = df[df[group_col] == selected_value]
+                selected_value = st.selectbox(f"Value from '{group_col}'", df[group_col].cat.categories)
+                df_view = df[df[group_col] == selected_value]
+
+        # Count ratings once with a bincount over the category codes (no hashing);
+        # reused by the proportion table and the chart
+        ratings = df_view["Predicted_Rating"].cat
+        counts = pd.Series(
+            np.bincount(ratings.codes.to_numpy(), minlength=len(ratings.categories)),
+            index=ratings.categories,
+            name="count",
+        )
 
         # Layout
         col1, col2 = st.columns(2)
 
         with col1:
             st.markdown("### 📋 Prediction Results")
-            st.dataframe(df, use_container_width=True)
+            st.dataframe(df_view, use_container_width=True)
 
             st.markdown("### 📈 Rating Proportion")
-            percent_df = df["Predicted_Rating"].value_counts(normalize=True).reset_index()
-            percent_df.columns = ["Rating", "Percentage"]
-            percent_df["Percentage"] = (percent_df["Percentage"] * 100).round(2).astype(str) + "%"
-            st.dataframe(percent_df, use_container_width=True)
+            percent_df = pd.DataFrame({"Rating": counts.index, "Percentage": (counts / counts.sum()).values})
+            st.dataframe(percent_df.style.format({"Percentage": "{:.2%}"}), use_container_width=True)
 
         with col2:
             st.markdown("### 📊 Rating Distribution")
             chart_option = st.radio("Chart Type", ["Bar", "Horizontal", "Pie"], horizontal=True)
-            counts = df["Predicted_Rating"].value_counts()
+            # Like value_counts before, only ratings that occur are drawn; the
+            # proportion table above still lists every rating
+            chart_counts = counts[counts > 0]
             if chart_option == "Bar":
-                st.bar_chart(counts)
-            elif chart_option == "Horizontal":
-                fig, ax = plt.subplots()
-                ax.barh(counts.index, counts.values, color="skyblue")
-                ax.set_xlabel("Count")
-                ax.set_ylabel("Rating")
-                st.pyplot(fig)
-            elif chart_option == "Pie":
-                fig, ax = plt.subplots()
-                ax.pie(counts, labels=counts.index, autopct='%1.1f%%', startangle=90)
-                ax.axis('equal')
-                st.pyplot(fig)
+                st.bar_chart(chart_counts)
+            else:
+                # Rendered client-side by Vega-Lite from the three counts
+                import altair as alt
+                chart_df = pd.DataFrame({"Rating": chart_counts.index.astype(str), "Count": chart_counts.values})
+                if chart_option == "Horizontal":
+                    chart = alt.Chart(chart_df).mark_bar(color="skyblue").encode(
+                        x=alt.X("Count:Q", title="Count"),
+                        y=alt.Y("Rating:N", title="Rating", sort=None),
+                    )
+                else:
+                    # Per-slice percentage labels, as matplotlib's autopct drew them
+                    chart_df["Percent"] = chart_df["Count"] / chart_df["Count"].sum()
+                    base = alt.Chart(chart_df).encode(
+                        theta=alt.Theta("Count:Q", stack=True),
+                        color=alt.Color("Rating:N", sort=None),
+                        tooltip=["Rating", "Count", alt.Tooltip("Percent:Q", format=".1%")],
+                    )
+                    chart = base.mark_arc(outerRadius=120) + base.mark_text(radius=140).encode(
+                        text=alt.Text("Percent:Q", format=".1%")
+                    )
+                st.altair_chart(chart, use_container_width=True)
 
         # Feature importance
         with st.expander("🧪 Feature Importance"):
-            if hasattr(model, "feature_importances_"):
-                importance_df = pd.DataFrame({
-                    "Feature": model.feature_names_in_,
-                    "Importance": model.feature_importances_
-                }).sort_values("Importance", ascending=False)
-                st.dataframe(importance_df.head(10), use_container_width=True)
+            if importance_df is not None:
+                st.dataframe(importance_df, use_container_width=True)
             else:
                 st.info("Model does not support feature importance.")
 
         # Download predictions
-        csv = df.to_csv(index=False).encode("utf-8")
+        csv = to_csv_bytes(df_view)
         st.download_button("📥 Download Prediction CSV", csv, "predicted_airbnb.csv", "text/csv")
 
     except Exception as e:
         st.error("Prediction failed. Please check your CSV formatting.")
         st.exception(e)
+else:
+    # Release the previous upload's predictions once the file is removed
+    st.session_state.pop("df_pred", None)
+    st.session_state.pop("pred_key", None)